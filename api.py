@@ -1,15 +1,15 @@
 from fastapi import FastAPI, Depends
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 import asyncio
 import random
-import csv
-import json
 import logging
+import os
+import orjson
 from pydantic import BaseModel
 from typing import List, Dict
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
@@ -18,20 +18,20 @@ logger.info("Starting API initialization")
 
 # Load product codes
 try:
-    with open('product_codes.csv', 'r') as f:
-        reader = csv.reader(f)
-        next(reader)  # Skip header
-        PRODUCT_CODES = [row[0] for row in reader]
+    with open('product_codes.csv', 'rb') as f:
+        lines = f.read().splitlines()[1:]  # Skip header
+    # Only the first column is needed, so split off just that cell per line
+    PRODUCT_CODES = tuple(line.split(b',', 1)[0].decode() for line in lines if line)
     logger.info(f"Loaded {len(PRODUCT_CODES)} product codes")
 except Exception as e:
     logger.error(f"Error loading product codes: {str(e)}")
-    PRODUCT_CODES = []
+    PRODUCT_CODES = ()
 
 # Load product graph
 try:
-    with open('productGraph.json', 'r') as f:
-        PRODUCT_GRAPH = json.load(f)
-        # Ensure PRODUCT_GRAPH is a dictionary
+    with open('ProductGraph.json', 'rb') as f:
+        PRODUCT_GRAPH = orjson.loads(f.read())
+        # Ensure PRODUCT_GRAPH is a dictionary keyed like PRODUCT_CODES (str)
         if isinstance(PRODUCT_GRAPH, list):
             PRODUCT_GRAPH = {str(item['product_code']): item for item in PRODUCT_GRAPH}
         logger.info(f"Loaded product graph with {len(PRODUCT_GRAPH)} items")
@@ -48,108 +48,151 @@ GENERIC_CLUSTERS = [
 ]
 logger.info(f"Defined {len(GENERIC_CLUSTERS)} generic clusters")
 
+# Dedicated generator so sampling doesn't go through the random module's shared instance
+_rng = random.Random()
+
+# Optional artificial delay between streamed records (seconds), for demo pacing
+STREAM_DELAY = float(os.environ.get("STREAM_DELAY", "0"))
+# Size of each slice of a pre-encoded body handed to a single ASGI send
+STREAM_CHUNK_SIZE = 8192
+
+# Shared fallback for codes missing from the graph; never mutated
+_EMPTY = {}
+
+def build_product(product_code):
+    product_info = PRODUCT_GRAPH.get(product_code, _EMPTY)
+    return {
+        "name": product_info.get('product_name', f"Product {product_code}"),
+        "id": product_code,
+        "price": product_info.get('price', 'N/A'),
+        "review_score": product_info.get('review_score', 'None'),
+        "image_sign_kit": product_info.get('image_sign_kit', ''),
+        "sport": product_info.get('sport', 'N/A'),
+        "brand": product_info.get('brand', 'N/A')
+    }
+
 class SearchSample(BaseModel):
     product_codes: List[str]
     clusters: List[str]
     associations: Dict[str, List[str]]
+    # Resolved and pre-encoded payloads, fixed until the next /new_search
+    products: List[dict]
+    products_json: bytes
+    products_ndjson: bytes
+    clusters_body: bytes
+    associations_ndjson: bytes
+    search_ndjson: bytes
 
 def generate_sample():
     # Sample 20-50 unique product codes
-    num_products = random.randint(20, 50)
-    sampled_product_codes = random.sample(PRODUCT_CODES, num_products)
+    num_products = _rng.randint(20, 50)
+    sampled_indices = _rng.sample(range(len(PRODUCT_CODES)), num_products)
+    sampled_product_codes = [PRODUCT_CODES[i] for i in sampled_indices]
     logger.info(f"Sampled {len(sampled_product_codes)} unique product codes")
 
     # Sample 5 unique clusters
-    sampled_clusters = random.sample(GENERIC_CLUSTERS, 5)
+    sampled_clusters = _rng.sample(GENERIC_CLUSTERS, 5)
     logger.info(f"Sampled clusters: {sampled_clusters}")
 
     # Generate random associations
     associations = {}
     for cluster in sampled_clusters:
-        num_associated = min(random.randint(3, 10), len(sampled_product_codes))
-        associations[cluster] = random.sample(sampled_product_codes, num_associated)
+        num_associated = min(_rng.randint(3, 10), len(sampled_product_codes))
+        associations[cluster] = _rng.sample(sampled_product_codes, num_associated)
     logger.info(f"Generated associations for {len(associations)} clusters")
 
+    # Resolve product records once so requests only copy pre-encoded bytes
+    products = [build_product(product_code) for product_code in sampled_product_codes]
+
+    # Tagged NDJSON for /search_stream: clusters first, then associations so the
+    # filter UI is ready, then products
+    search_records = (
+        [{"t": "c", "d": cluster} for cluster in sampled_clusters]
+        + [{"t": "a", "d": {"cluster": cluster, "products": codes}} for cluster, codes in associations.items()]
+        + [{"t": "p", "d": product} for product in products]
+    )
+
     return SearchSample(
         product_codes=sampled_product_codes,
         clusters=sampled_clusters,
-        associations=associations
+        associations=associations,
+        products=products,
+        products_json=orjson.dumps(products),
+        products_ndjson=b"".join(orjson.dumps(product) + b"\n" for product in products),
+        clusters_body="".join(f"{cluster}\n" for cluster in sampled_clusters).encode(),
+        associations_ndjson=b"".join(
+            orjson.dumps({"cluster": cluster, "products": codes}) + b"\n"
+            for cluster, codes in associations.items()
+        ),
+        search_ndjson=b"".join(orjson.dumps(record) + b"\n" for record in search_records)
     )
 
 async def get_search_sample():
-    if not hasattr(app.state, 'current_sample'):
-        app.state.current_sample = generate_sample()
+    # current_sample is set in startup_event before any request is served
     return app.state.current_sample
 
-async def stream_cluster_names(clusters):
-    logger.info("Starting to stream cluster names")
-    for cluster in clusters:
-        logger.debug(f"Streaming cluster: {cluster}")
-        yield f"{cluster}\n"
-        await asyncio.sleep(0.1)  # Simulate some delay
-    logger.info("Finished streaming cluster names")
-
-async def stream_products(product_codes):
-    logger.info("Starting to stream products")
-    for product_code in product_codes:
-        product_info = PRODUCT_GRAPH.get(str(product_code), {})
-        product_name = product_info.get('product_name', f"Product {product_code}")
-        price = product_info.get('price', 'N/A')
-        review_score = product_info.get('review_score', 'None')
-        image_sign_kit = product_info.get('image_sign_kit', '')
-        sport = product_info.get('sport', 'N/A')
-        brand = product_info.get('brand', 'N/A')
-        logger.info(f"Streaming product: {product_name} ({product_code})")
-        yield f"{product_name}|{product_code}|{price}|{review_score}|{image_sign_kit}|{sport}|{brand}\n"
-        await asyncio.sleep(0.1)  # Simulate some delay
-    logger.info("Finished streaming products")
-
-async def stream_associations(associations):
-    logger.info("Starting to stream associations")
-    for cluster, products in associations.items():
-        logger.debug(f"Streaming association for cluster: {cluster}")
-        yield f"{cluster}: {','.join(products)}\n"
-        await asyncio.sleep(0.1)  # Simulate some delay
-    logger.info("Finished streaming associations")
+async def stream_lines(data, label):
+    logger.info(f"Starting to stream {label}")
+    if STREAM_DELAY:
+        # Paced demo mode: send one record at a time
+        for line in data.splitlines(keepends=True):
+            logger.debug("Streaming %s record: %r", label, line)
+            yield line
+            await asyncio.sleep(STREAM_DELAY)  # Simulate some delay
+    else:
+        # The body is already encoded, so just hand out fixed-size slices of it
+        view = memoryview(data)
+        for start in range(0, len(view), STREAM_CHUNK_SIZE):
+            yield bytes(view[start:start + STREAM_CHUNK_SIZE])
+    logger.info(f"Finished streaming {label}")
 
 @app.get("/clusters")
 async def get_clusters(sample: SearchSample = Depends(get_search_sample)):
+    logger.info("Received request for clusters")
+    return Response(sample.clusters_body, media_type="text/plain")
+
+@app.get("/clusters_stream")
+async def get_clusters_stream(sample: SearchSample = Depends(get_search_sample)):
     logger.info("Received request for clusters (streaming)")
-    return StreamingResponse(stream_cluster_names(sample.clusters), media_type="text/plain")
+    return StreamingResponse(stream_lines(sample.clusters_body, "cluster names"), media_type="text/plain")
 
 @app.get("/products")
+@app.get("/products_non_streaming")  # Kept as an alias for existing clients
 async def get_products(sample: SearchSample = Depends(get_search_sample)):
+    logger.info("Received request for products")
+    logger.info(f"Returning {len(sample.products)} products")
+    return Response(sample.products_json, media_type="application/json")
+
+@app.get("/products_stream")
+async def get_products_stream(sample: SearchSample = Depends(get_search_sample)):
     logger.info("Received request for products (streaming)")
-    return StreamingResponse(stream_products(sample.product_codes), media_type="text/plain")
+    return StreamingResponse(stream_lines(sample.products_ndjson, "products"), media_type="application/x-ndjson")
 
 @app.get("/associations")
 async def get_associations(sample: SearchSample = Depends(get_search_sample)):
+    logger.info("Received request for associations")
+    return Response(sample.associations_ndjson, media_type="application/x-ndjson")
+
+@app.get("/associations_stream")
+async def get_associations_stream(sample: SearchSample = Depends(get_search_sample)):
     logger.info("Received request for associations (streaming)")
-    return StreamingResponse(stream_associations(sample.associations), media_type="text/plain")
+    return StreamingResponse(stream_lines(sample.associations_ndjson, "associations"), media_type="application/x-ndjson")
+
+@app.get("/search")
+async def get_search(sample: SearchSample = Depends(get_search_sample)):
+    logger.info("Received request for multiplexed search records")
+    return Response(sample.search_ndjson, media_type="application/x-ndjson")
+
+@app.get("/search_stream")
+async def get_search_stream(sample: SearchSample = Depends(get_search_sample)):
+    logger.info("Received request for multiplexed search stream")
+    return StreamingResponse(stream_lines(sample.search_ndjson, "search records"), media_type="application/x-ndjson")
 
 @app.get("/clusters_non_streaming")
 async def get_clusters_non_streaming(sample: SearchSample = Depends(get_search_sample)):
     logger.info("Received request for clusters (non-streaming)")
     return JSONResponse(content=sample.clusters)
 
-@app.get("/products_non_streaming")
-async def get_products_non_streaming(sample: SearchSample = Depends(get_search_sample)):
-    logger.info("Received request for products (non-streaming)")
-    products = []
-    for product_code in sample.product_codes:
-        product_info = PRODUCT_GRAPH.get(str(product_code), {})
-        products.append({
-            "name": product_info.get('product_name', f"Product {product_code}"),
-            "id": product_code,
-            "price": product_info.get('price', 'N/A'),
-            "review_score": product_info.get('review_score', 'None'),
-            "image_sign_kit": product_info.get('image_sign_kit', ''),
-            "sport": product_info.get('sport', 'N/A'),
-            "brand": product_info.get('brand', 'N/A')
-        })
-    logger.info(f"Returning {len(products)} products")
-    return JSONResponse(content=products)
-
 @app.get("/associations_non_streaming")
 async def get_associations_non_streaming(sample: SearchSample = Depends(get_search_sample)):
     logger.info("Received request for associations (non-streaming)")
@@ -157,12 +200,14 @@ async def get_associations_non_streaming(sample: SearchSample = Depends(get_sear
 
 @app.post("/new_search")
 async def new_search():
-    app.state.current_sample = generate_sample()
+    async with app.state.sample_lock:
+        app.state.current_sample = generate_sample()
     return {"message": "New search sample generated"}
 
 @app.on_event("startup")
 async def startup_event():
     logger.info("API is starting up")
+    app.state.sample_lock = asyncio.Lock()
     app.state.current_sample = generate_sample()
 
 @app.on_event("shutdown")
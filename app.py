@@ -1,14 +1,18 @@
 import streamlit as st
 import aiohttp
 import asyncio
+import atexit
+import functools
+import threading
 from streamlit_lottie import st_lottie
-import requests
 import time
 import json
 import logging
+import os
+import orjson
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "DEBUG").upper())
 logger = logging.getLogger(__name__)
 
 # Set page config
@@ -159,63 +163,106 @@ async def fetch_stream(session, url, max_retries=3):
                 raise
             await asyncio.sleep(1)  # Wait before retrying
 
-async def fetch_data(query):
-    async with aiohttp.ClientSession() as session:
-        try:
-            # Call new_search endpoint to generate a new sample
-            async with session.post("http://localhost:8066/new_search") as response:
-                if response.status != 200:
-                    raise Exception("Failed to start a new search")
-
-            clusters_task = fetch_stream(session, "http://localhost:8066/clusters")
-            products_task = fetch_stream(session, "http://localhost:8066/products")
-            associations_task = fetch_stream(session, "http://localhost:8066/associations")
-
-            clusters = []
-            products = []
-            associations = {}
-
-            async for cluster in clusters_task:
-                if cluster not in clusters:
+@st.cache_resource
+def get_event_loop():
+    # One long-lived loop on a background thread, shared by every browser session.
+    # Keeping it running lets the shared aiohttp session notice server-side closes
+    # of pooled connections between reruns.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="http-loop", daemon=True).start()
+    return loop
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+def iterate_async(agen):
+    # Drive an async generator on the background loop from the script thread, so
+    # Streamlit calls made while consuming it keep their script run context
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_async(agen.aclose())
+
+async def create_http_session():
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=30)
+    )
+
+@st.cache_resource
+def get_http_session():
+    session = run_async(create_http_session())
+    atexit.register(lambda: run_async(session.close()))
+    return session
+
+async def fetch_data(session, query):
+    try:
+        # Call new_search endpoint to generate a new sample
+        async with session.post("http://localhost:8066/new_search") as response:
+            if response.status != 200:
+                raise Exception("Failed to start a new search")
+
+        clusters = []
+        products = []
+        associations = {}
+        seen_clusters = set()
+        seen_products = set()
+
+        # One multiplexed NDJSON stream, dispatched by record tag
+        async for line in fetch_stream(session, "http://localhost:8066/search_stream"):
+            if not line:
+                continue
+            msg = orjson.loads(line)
+            tag, data = msg["t"], msg["d"]
+            if tag == "c":
+                cluster = data
+                if cluster not in seen_clusters:
+                    seen_clusters.add(cluster)
                     clusters.append(cluster)
-                    logger.debug(f"Received cluster: {cluster}")
+                    logger.debug("Received cluster: %s", cluster)
                     yield {"type": "cluster", "data": cluster}
-
-            async for product in products_task:
-                product_dict = dict(zip(['name', 'id', 'price', 'review_score', 'image_sign_kit', 'sport', 'brand'], product.split('|')))
-                if product_dict['id'] not in [p['id'] for p in products]:
+            elif tag == "p":
+                product_dict = data
+                if product_dict['id'] not in seen_products:
+                    seen_products.add(product_dict['id'])
                     products.append(product_dict)
-                    logger.info(f"Received product: {product_dict}")
+                    logger.debug("Received product: %s", product_dict)
                     yield {"type": "product", "data": product_dict}
-
-            async for association in associations_task:
-                cluster, product_ids = association.split(': ')
-                associations[cluster] = product_ids.split(',')
-                logger.info(f"Received association: {cluster} - {product_ids}")
-                yield {"type": "association", "data": {cluster: product_ids.split(',')}}
-
-            yield {"type": "complete", "data": {
-                "clusters": clusters,
-                "products": products,
-                "associations": associations
-            }}
-            logger.info("Data fetching complete")
-
-        except Exception as e:
-            logger.error(f"Error fetching data: {str(e)}")
-            yield {"type": "error", "data": str(e)}
-
-def  get_review_stars(review_score):
+            elif tag == "a":
+                cluster, product_ids = data["cluster"], data["products"]
+                associations[cluster] = product_ids
+                logger.debug("Received association: %s - %s", cluster, product_ids)
+                yield {"type": "association", "data": {cluster: product_ids}}
+
+        yield {"type": "complete", "data": {
+            "clusters": clusters,
+            "products": products,
+            "associations": associations
+        }}
+        logger.info("Data fetching complete")
+
+    except Exception as e:
+        logger.error(f"Error fetching data: {str(e)}")
+        yield {"type": "error", "data": str(e)}
+
+@functools.lru_cache(maxsize=10000)
+def review_stars(review_score):
     if review_score is None or review_score == 'None':
         return "No reviews yet"
-    
+    # Invalid scores raise here, and lru_cache doesn't cache exceptions
+    return '⭐' * int(round(float(review_score)))
+
+def get_review_stars(review_score):
     try:
-        score = float(review_score)
-        return '⭐' * int(round(score))
+        return review_stars(review_score)
     except ValueError:
         logger.warning(f"Invalid review score: {review_score}")
         return "Invalid review score"
 
+@functools.lru_cache(maxsize=10000)
 def get_image_url(image_sign_kit):
     if not image_sign_kit or image_sign_kit == 'N/A':
         return "https://via.placeholder.com/600x600?text=No+Image"
@@ -223,13 +270,20 @@ def get_image_url(image_sign_kit):
     image_pixel_id = image_sign_kit if image_sign_kit.startswith("p") else f"p{image_sign_kit}"
     return f"https://contents.mediadecathlon.com/{image_pixel_id}/?format=png&quality=100&f=600x600"
 
+async def fetch_lottie(session, url: str):
+    async with session.get(
+        url,
+        headers={"Accept-Encoding": "gzip"},
+        timeout=aiohttp.ClientTimeout(total=5),  # Don't hold up a cold page load on a slow host
+    ) as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
+
 @st.cache_data
 def load_lottie_url(url: str):
     try:
-        r = requests.get(url)
-        r.raise_for_status()
-        return r.json()
-    except requests.RequestException as e:
+        return run_async(fetch_lottie(get_http_session(), url))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
         logger.error(f"Error loading Lottie animation: {str(e)}")
         return None
 
@@ -248,8 +302,16 @@ def initialize_session_state():
         st.session_state.debug_data = {}
     if 'active_cluster' not in st.session_state:
         st.session_state.active_cluster = "All Products"
+    if 'products_by_cluster' not in st.session_state:
+        st.session_state.products_by_cluster = {"All Products": st.session_state.products}
+    if 'product_ids_text' not in st.session_state:
+        st.session_state.product_ids_text = ""
+    if 'associations_log_text' not in st.session_state:
+        st.session_state.associations_log_text = ""
 
 def debug_print_state():
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
     logger.debug("Current state:")
     logger.debug(f"Total products: {len(st.session_state.products)}")
     logger.debug(f"Clusters: {st.session_state.clusters}")
@@ -257,48 +319,70 @@ def debug_print_state():
     for product in st.session_state.products[:5]:  # Print first 5 products for debugging
         logger.debug(f"Product: {product}")
 
+def format_associations_log(associations):
+    return "\n\n".join(
+        f"{cluster}:\n" + "\n".join(associated_products)
+        for cluster, associated_products in associations.items()
+    )
+
+def group_products_by_cluster(products, associations):
+    products_by_cluster = {"All Products": products}
+    for cluster, product_ids in associations.items():
+        associated_product_ids = set(product_ids)
+        products_by_cluster[cluster] = [
+            product for product in products
+            if product['id'] in associated_product_ids
+        ]
+    return products_by_cluster
+
 def filter_products(cluster):
-    logger.debug(f"Filtering products for cluster: {cluster}")
-    if not cluster or cluster == "All Products":
-        logger.debug(f"Returning all products: {len(st.session_state.products)}")
-        return st.session_state.products
-    
-    associated_product_ids = set(st.session_state.associations.get(cluster, []))
-    logger.debug(f"Associated product IDs for {cluster}: {associated_product_ids}")
-    
-    filtered_products = [
-        product for product in st.session_state.products
-        if product['id'] in associated_product_ids
-    ]
-    logger.debug(f"Filtered products: {len(filtered_products)}")
+    logger.debug("Filtering products for cluster: %s", cluster)
+    if not cluster:
+        cluster = "All Products"
+
+    filtered_products = st.session_state.products_by_cluster.get(cluster, [])
+    logger.debug("Filtered products: %d", len(filtered_products))
     if len(filtered_products) == 0:
         logger.warning(f"No products found after filtering for cluster: {cluster}")
-        logger.debug("Product IDs in main list vs. association:")
-        for product in st.session_state.products[:10]:  # Check first 10 products
-            logger.debug(f"Product ID: {product['id']}, In association: {product['id'] in associated_product_ids}")
     return filtered_products
 
-async def perform_search(query):
+def perform_search(query):
     logger.info(f"Performing search for query: {query}")
     st.session_state.clusters = []
     st.session_state.products = []
     st.session_state.associations = {}
+    st.session_state.products_by_cluster = {}
+    st.session_state.product_ids_text = ""
+    st.session_state.associations_log_text = ""
     st.session_state.active_cluster = "All Products"
 
     progress_bar = st.progress(0)
     status_text = st.empty()
     product_container = st.empty()
 
-    async def stream_data():
-        async for item in fetch_data(query):
+    # Pre-create the grid once and append each streamed product to the next slot
+    with product_container.container():
+        product_header = st.empty()
+        product_cols = st.columns(4)
+    next_slot = 0
+
+    def stream_data():
+        nonlocal next_slot
+        error = None
+        for item in iterate_async(fetch_data(get_http_session(), query)):
             if item["type"] == "cluster":
                 st.session_state.clusters.append(item["data"])
             elif item["type"] == "product":
                 st.session_state.products.append(item["data"])
-                display_products(st.session_state.products, product_container)
+                product_header.subheader(f"Recommended Gear ({len(st.session_state.products)} items)")
+                with product_cols[next_slot % 4]:
+                    display_product_card(item["data"])
+                next_slot += 1
             elif item["type"] == "association":
                 st.session_state.associations.update(item["data"])
-            elif item["type"] == "complete":
+            elif item["type"] == "error":
+                error = item["data"]
+            elif item["type"] == "complete" and st.session_state.get("debug_mode", False):
                 logger.debug("Data fetching complete. Final state:")
                 debug_print_state()
             
@@ -306,17 +390,41 @@ async def perform_search(query):
             progress_bar.progress(progress)
             status_text.text(f"Loading... {progress}%")
 
+        # Products and associations are fixed for this sample, so group them once
+        st.session_state.products_by_cluster = group_products_by_cluster(
+            st.session_state.products, st.session_state.associations
+        )
+        st.session_state.product_ids_text = "\n".join(
+            product['id'] for product in st.session_state.products
+        )
+        st.session_state.associations_log_text = format_associations_log(st.session_state.associations)
+
         progress_bar.empty()
         status_text.empty()
+        if error is not None:
+            # Record the attempted query so later reruns don't refire the failed search
+            st.session_state.search_performed = False
+            st.session_state.last_search_query = query
+            st.error(f"Search failed: {error}")
+            return
         st.session_state.search_performed = True
         st.session_state.last_search_query = query
         logger.info(f"Search complete. Found {len(st.session_state.products)} products across {len(st.session_state.clusters)} categories.")
         st.success(f"Found {len(st.session_state.products)} products across {len(st.session_state.clusters)} categories.")
 
-    await stream_data()
+    stream_data()
+
+def display_product_card(product):
+    with st.container():
+        st.image(get_image_url(product['image_sign_kit']), use_column_width=True)
+        st.markdown(f"**{product['name']}**")
+        st.write(f"Brand: {product['brand']}")
+        st.write(f"Sport: {product['sport']}")
+        st.write(get_review_stars(product['review_score']))
+        st.markdown(f"**${product['price']}**")
 
 def display_products(products, container):
-    logger.debug(f"Displaying {len(products)} products")
+    logger.debug("Displaying %d products", len(products))
     container.empty()  # Clear the previous content
     with container:
         if products:
@@ -324,13 +432,7 @@ def display_products(products, container):
             cols = st.columns(4)
             for i, product in enumerate(products):
                 with cols[i % 4]:
-                    with st.container():
-                        st.image(get_image_url(product['image_sign_kit']), use_column_width=True)
-                        st.markdown(f"**{product['name']}**")
-                        st.write(f"Brand: {product['brand']}")
-                        st.write(f"Sport: {product['sport']}")
-                        st.write(get_review_stars(product['review_score']))
-                        st.markdown(f"**${product['price']}**")
+                    display_product_card(product)
         else:
             st.info("No products found. Try adjusting your search or filters.")
 
@@ -355,11 +457,9 @@ def main():
     st.markdown('</div>', unsafe_allow_html=True)
 
     if search_query and search_query != st.session_state.last_search_query:
-        asyncio.run(perform_search(search_query))
+        perform_search(search_query)
 
     if st.session_state.search_performed:
-        debug_print_state()  # Add this line to print debug information
-
         # Sidebar for cluster selection and logs
         st.sidebar.title("Filter by Category")
         cluster_options = ["All Products"] + st.session_state.clusters
@@ -374,19 +474,20 @@ def main():
         product_container = st.empty()
         display_products(filtered_products, product_container)
 
-        # Log of product IDs and cluster associations
-        st.sidebar.title("Product and Cluster Log")
-        
-        # Product IDs log
-        st.sidebar.subheader("Retrieved Product IDs")
-        product_ids = [product['id'] for product in st.session_state.products]
-        st.sidebar.code("\n".join(product_ids))
-
-        # Cluster associations log
-        st.sidebar.subheader("Cluster Associations")
-        for cluster, associated_products in st.session_state.associations.items():
-            st.sidebar.write(f"**{cluster}**")
-            st.sidebar.code("\n".join(associated_products))
+        # Debug output is opt-in so regular reruns skip it
+        if st.sidebar.checkbox("Debug", value=False, key="debug_mode"):
+            debug_print_state()
+
+            # Log of product IDs and cluster associations
+            st.sidebar.title("Product and Cluster Log")
+
+            # Product IDs log
+            st.sidebar.subheader("Retrieved Product IDs")
+            st.sidebar.code(st.session_state.product_ids_text)
+
+            # Cluster associations log
+            st.sidebar.subheader("Cluster Associations")
+            st.sidebar.code(st.session_state.associations_log_text)
 
     elif not st.session_state.search_performed:
         # Display Lottie animation when no search has been performed